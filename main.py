@@ -25,6 +25,15 @@ add_routes(
 )
 
 if __name__ == "__main__":
+    import os
     import uvicorn
 
-    uvicorn.run(app, host="localhost", port=8000)
\ No newline at end of file
+    # Workers need an import string so each process builds its own app
+    uvicorn.run(
+        "main:app",
+        host="localhost",
+        port=8000,
+        workers=os.cpu_count(),
+        loop="auto",  # uvloop when installed (not available on Windows)
+        http="httptools",
+    )
\ No newline at end of file
@@ -0,0 +1,250 @@
+# analysis_cache.py - Two-tier cache for competitor analysis reports
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Tuple, List, Dict
+
+import numpy as np
+
+# Minimum cosine similarity for a semantic cache hit
+SIMILARITY_THRESHOLD = 0.93
+
+# Reports older than this are treated as stale and recomputed
+TTL_SECONDS = float(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", "3600"))
+
+# Maximum number of cached reports; the oldest are evicted first
+MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "1000"))
+
+# Optional on-disk .npz snapshot of the cache (disabled when unset)
+SNAPSHOT_PATH = os.getenv("ANALYSIS_CACHE_PATH")
+SNAPSHOT_EVERY = 10  # Number of puts between snapshots
+
+_INITIAL_VECTOR_ROWS = 64  # The embedding matrix doubles from here when it fills up
+
+# Exact tier: SHA256 of the normalized key tuple -> entry, oldest first.
+# Each entry holds "report", "created_at", "scope" and "slot" (its embedding row, or None).
+_entries: "OrderedDict[str, dict]" = OrderedDict()
+
+# Semantic tier: normalized embeddings in a pre-allocated matrix. Similarity is only
+# searched among entries with the same exact (company, industry) scope.
+_vectors: Optional[np.ndarray] = None
+_free_slots: List[int] = []
+_scope_slots: Dict[Tuple[str, str], Dict[int, str]] = {}  # scope -> {slot: key}
+
+_puts_since_snapshot = 0
+
+def _normalize_text(value: str) -> str:
+    return value.strip().lower()
+
+def make_key(key_tuple: Tuple[str, ...]) -> str:
+    """Hash a (company, industry, competitor) tuple, ignoring case and surrounding whitespace."""
+    normalized = "\x1f".join(_normalize_text(part) for part in key_tuple)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def _scope(key_tuple: Tuple[str, ...]) -> Tuple[str, str]:
+    company, industry = key_tuple[0], key_tuple[1]
+    return (_normalize_text(company), _normalize_text(industry))
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def _store_vector(vector: np.ndarray) -> Optional[int]:
+    """Place a normalized vector in a free matrix row, growing the matrix if needed."""
+    global _vectors
+    if _vectors is None:
+        _vectors = np.zeros((_INITIAL_VECTOR_ROWS, vector.shape[0]), dtype=np.float32)
+        _free_slots.extend(range(_INITIAL_VECTOR_ROWS - 1, -1, -1))
+    elif _vectors.shape[1] != vector.shape[0]:
+        return None
+    if not _free_slots:
+        capacity = _vectors.shape[0]
+        _vectors = np.concatenate([_vectors, np.zeros_like(_vectors)])
+        _free_slots.extend(range(2 * capacity - 1, capacity - 1, -1))
+    slot = _free_slots.pop()
+    _vectors[slot] = vector
+    return slot
+
+def _evict(key: str):
+    entry = _entries.pop(key)
+    slot = entry["slot"]
+    if slot is not None:
+        slots = _scope_slots[entry["scope"]]
+        del slots[slot]
+        if not slots:
+            del _scope_slots[entry["scope"]]
+        _free_slots.append(slot)
+
+def _expire():
+    """Drop entries older than TTL_SECONDS (entries are kept oldest first)."""
+    cutoff = time.time() - TTL_SECONDS
+    while _entries:
+        key, entry = next(iter(_entries.items()))
+        if entry["created_at"] >= cutoff:
+            break
+        _evict(key)
+
+def get(key_tuple: Tuple[str, ...], embedding: Optional[List[float]] = None) -> Optional[str]:
+    """Return a fresh cached report by exact key, or by competitor-embedding similarity within
+    the same company and industry when an embedding is given."""
+    _expire()
+    entry = _entries.get(make_key(key_tuple))
+    if entry is not None:
+        return entry["report"]
+    if embedding is None:
+        return None
+
+    slots = _scope_slots.get(_scope(key_tuple))
+    if not slots:
+        return None
+    query = _normalize(embedding)
+    if query.shape[0] != _vectors.shape[1]:
+        return None
+    candidates = np.fromiter(slots.keys(), dtype=np.intp, count=len(slots))
+    scores = _vectors[candidates] @ query
+    best = int(np.argmax(scores))
+    if scores[best] >= SIMILARITY_THRESHOLD:
+        return _entries[slots[int(candidates[best])]]["report"]
+    return None
+
+def has_semantic_candidates(key_tuple: Tuple[str, ...]) -> bool:
+    """Whether any fresh embedded entries share this tuple's company and industry."""
+    _expire()
+    return bool(_scope_slots.get(_scope(key_tuple)))
+
+def _insert(key: str, scope: Tuple[str, str], embedding: Optional[List[float]], report: str,
+            created_at: float):
+    if key in _entries:
+        _evict(key)
+    while len(_entries) >= MAX_ENTRIES:
+        _evict(next(iter(_entries)))
+
+    slot = _store_vector(_normalize(embedding)) if embedding is not None else None
+    if slot is not None:
+        _scope_slots.setdefault(scope, {})[slot] = key
+    _entries[key] = {
+        "report": report,
+        "created_at": created_at,
+        "scope": scope,
+        "slot": slot,
+    }
+
+def put(key_tuple: Tuple[str, ...], embedding: Optional[List[float]], report: str):
+    """Store a report under its exact key and, if available, its competitor embedding."""
+    global _puts_since_snapshot
+    _insert(make_key(key_tuple), _scope(key_tuple), embedding, report, time.time())
+    _puts_since_snapshot += 1
+
+def snapshot_due() -> bool:
+    """Whether enough puts have happened since the last snapshot to write a new one."""
+    return bool(SNAPSHOT_PATH) and _puts_since_snapshot >= SNAPSHOT_EVERY
+
+def _snapshot_payload() -> Tuple[List[dict], Optional[np.ndarray]]:
+    """Copy the cache contents so they can be serialized off the event loop."""
+    entries, slots = [], []
+    for key, entry in _entries.items():
+        row = None
+        if entry["slot"] is not None:
+            row = len(slots)
+            slots.append(entry["slot"])
+        entries.append({
+            "key": key,
+            "scope": list(entry["scope"]),
+            "report": entry["report"],
+            "created_at": entry["created_at"],
+            "row": row,
+        })
+    vectors = _vectors[slots] if slots else None  # Fancy indexing returns a copy
+    return entries, vectors
+
+def _read_snapshot(path: str) -> Tuple[List[dict], Optional[np.ndarray]]:
+    """Read snapshot entry metadata and the embedding matrix their "row" fields index into."""
+    if not os.path.exists(path):
+        return [], None
+    with np.load(path, allow_pickle=False) as data:
+        return json.loads(data["entries"].tobytes().decode("utf-8")), data["vectors"]
+
+@contextmanager
+def _snapshot_lock(path: str):
+    """Serialize snapshot writers across server workers (best effort where fcntl is unavailable)."""
+    with open(f"{path}.lock", "w") as lock_file:
+        try:
+            import fcntl  # POSIX only; the lock is released when the file is closed
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        yield
+
+def _write_snapshot(entries: List[dict], vectors: Optional[np.ndarray], path: str):
+    try:
+        # Each server worker holds only part of the cache, so merge with what other workers
+        # already wrote (newest entry per key wins)
+        with _snapshot_lock(path):
+            disk_entries, disk_vectors = _read_snapshot(path)
+            cutoff = time.time() - TTL_SECONDS
+            merged = {}
+            for source_entries, source_vectors in ((disk_entries, disk_vectors), (entries, vectors)):
+                for entry in source_entries:
+                    current = merged.get(entry["key"])
+                    if entry["created_at"] >= cutoff and (current is None or entry["created_at"] > current[0]["created_at"]):
+                        merged[entry["key"]] = (entry, source_vectors)
+            newest = sorted(merged.values(), key=lambda item: item[0]["created_at"])[-MAX_ENTRIES:]
+
+            # Embeddings go into one binary float32 matrix instead of JSON float text
+            out_entries, rows = [], []
+            for entry, source_vectors in newest:
+                row = None
+                if entry["row"] is not None:
+                    vector = source_vectors[entry["row"]]
+                    if not rows or vector.shape == rows[0].shape:
+                        row = len(rows)
+                        rows.append(vector)
+                out_entries.append({**entry, "row": row})
+            out_vectors = np.stack(rows) if rows else np.zeros((0, 0), dtype=np.float32)
+
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                metadata = np.frombuffer(json.dumps(out_entries).encode("utf-8"), dtype=np.uint8)
+                np.savez(f, entries=metadata, vectors=out_vectors)
+            os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"❌ Failed to snapshot analysis cache: {str(e)}")
+
+async def save_snapshot_async(path: Optional[str] = None):
+    """Write the cache to disk, serializing in a worker thread."""
+    global _puts_since_snapshot
+    path = path or SNAPSHOT_PATH
+    if not path:
+        return
+    _expire()
+    entries, vectors = _snapshot_payload()
+    _puts_since_snapshot = 0
+    await asyncio.to_thread(_write_snapshot, entries, vectors, path)
+
+def load_snapshot(path: Optional[str] = None):
+    """Load the unexpired entries of a previously written snapshot, if one exists."""
+    global _puts_since_snapshot
+    path = path or SNAPSHOT_PATH
+    if not path or not os.path.exists(path):
+        return
+    try:
+        entries, vectors = _read_snapshot(path)
+        cutoff = time.time() - TTL_SECONDS
+        fresh = sorted(
+            (entry for entry in entries if entry["created_at"] >= cutoff),
+            key=lambda entry: entry["created_at"]
+        )
+        for entry in fresh:
+            embedding = vectors[entry["row"]] if entry["row"] is not None else None
+            _insert(entry["key"], tuple(entry["scope"]), embedding, entry["report"], entry["created_at"])
+        _puts_since_snapshot = 0
+        print(f"✅ Loaded {len(_entries)} cached competitor analysis reports")
+    except Exception as e:
+        print(f"❌ Failed to load analysis cache snapshot: {str(e)}")
+
+load_snapshot()
@@ -1,14 +1,25 @@
 # competitor_analysis_agent.py - Competitor Analysis Agent for MCP exposure
 import os
 import json
-from typing import TypedDict, Optional, List, Dict
+import asyncio
+import re
+import threading
+from contextvars import ContextVar
+from typing import TypedDict, Optional, List, Dict, Tuple
 from typing_extensions import Annotated
 from dotenv import load_dotenv
 from langgraph.graph import StateGraph, START, END
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception
 import operator
-import pandas as pd
 from sqlalchemy import create_engine, text
+from sqlalchemy.engine import URL
+
+try:
+    from server import analysis_cache
+except ImportError:  # Running from inside server/ (e.g. mcp_main.py)
+    import analysis_cache
 
 # Load environment variables
 load_dotenv()
@@ -17,19 +28,115 @@ load_dotenv()
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 MODEL = "perplexity/sonar-reasoning"  # Using the sonar-reasoning model as specified
 
+EMBEDDING_MODEL = "openai/text-embedding-3-small"  # Used for semantic cache lookups on competitor names
+EMBEDDING_TIMEOUT_SECONDS = 5  # The cache is optional, so never wait long for an embedding
+
+# Matches any report line mentioning a key insight indicator
+_INSIGHT_LINE_RE = re.compile(
+    r"^.*(?:strength|weakness|opportunity|threat|advantage|gap|recommendation).*$",
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Transient OpenRouter failures worth retrying, and the backoff between attempts
+RETRYABLE_LLM_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+# Mid-stream error codes that a retry cannot fix
+NON_TRANSIENT_STREAM_ERROR_CODES = {
+    "invalid_request_error",
+    "authentication_error",
+    "permission_error",
+    "context_length_exceeded",
+    "content_filter",
+}
+_EXPONENTIAL_BACKOFF = wait_exponential_jitter(initial=1, max=30)
+MAX_RETRY_AFTER_SECONDS = 60  # Upper bound on how long a Retry-After header can stall a request
+
+# Maximum number of analyses in flight at once (respects OpenRouter rate limits)
+MAX_CONCURRENT_ANALYSES = 20
+
 
 
 # Database configuration
 DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD").replace("@", "%40")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_NAME = os.getenv("DB_NAME")
 DB_PORT = os.getenv("DB_PORT")
+def db_pool_limits(max_connections: int, workers: int) -> Tuple[int, int]:
+    """Split a connection budget into one worker's (pool_size, max_overflow), capped at 10 + 20."""
+    # A pool needs at least one connection, so only more workers than connections can overshoot
+    share = max(1, max_connections // max(1, workers))
+    pool_size = min(10, max(1, share // 3))
+    return pool_size, min(20, share - pool_size)
+
+# Each server worker process has its own pool, so split the Postgres connection budget
+# (keep DB_MAX_CONNECTIONS below the server's max_connections) across WEB_CONCURRENCY workers
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "80"))
+DB_POOL_SIZE, DB_MAX_OVERFLOW = db_pool_limits(DB_MAX_CONNECTIONS, int(os.getenv("WEB_CONCURRENCY", "1")))
+# Built from parts so the raw password needs no manual URL escaping
+DATABASE_URL = URL.create(
+    drivername="postgresql+psycopg2",
+    username=DB_USER,
+    password=DB_PASSWORD,
+    host=DB_HOST,
+    port=int(DB_PORT) if DB_PORT else None,
+    database=DB_NAME
+)
+
+# In-flight background tasks (referenced so they are not garbage-collected)
+_background_tasks = set()
+
+# Report inserts started within the current batch_analyze call, if any
+_batch_insert_tasks: ContextVar[Optional[set]] = ContextVar("batch_insert_tasks", default=None)
+
+# Shared SQLAlchemy engine, created on first use (from worker threads as well)
+# Same columns pandas' to_sql created on first write, for databases set up before this DDL
+CREATE_REPORTS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS social_media_competitor_analysis_logs (
+    company TEXT,
+    industry TEXT,
+    competitor TEXT,
+    report TEXT
+)
+"""
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
 
-# Create OpenRouter client
-client = OpenAI(
+def get_engine():
+    """Return the shared connection-pooled SQLAlchemy engine."""
+    global _ENGINE
+    if _ENGINE is not None:
+        return _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            engine = create_engine(
+                DATABASE_URL,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_pre_ping=True,
+                pool_recycle=1800
+            )
+            try:
+                # Reports are inserted in the background, so make sure the table exists up front
+                with engine.begin() as conn:
+                    conn.execute(text(CREATE_REPORTS_TABLE_SQL))
+            except Exception:
+                engine.dispose()
+                raise
+            _ENGINE = engine
+    return _ENGINE
+
+# Create async OpenRouter client
+aclient = AsyncOpenAI(
     base_url="https://openrouter.ai/api/v1",
     api_key=OPENROUTER_API_KEY,
+    timeout=120,
+    max_retries=0,  # Retries are handled by tenacity in generate_analysis_report
 )
 
 # Define clear input schema for MCP exposure
@@ -53,118 +160,201 @@ class AgentState(AgentInput, AgentOutput):
 def insert_competitor_analysis_report(company: str, industry: str, competitor: str, report: str):
     """Insert a competitor analysis report into the database."""
     try:
-        engine = create_engine(
-            f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-        )
-        # Prepare the data as a DataFrame
-        df = pd.DataFrame([
-            {
-                "company": company,
-                "industry": industry,
-                "competitor": competitor,
-                "report": report
-            }
-        ])
-        # Insert into the table (create if not exists)
-        df.to_sql(
-            'social_media_competitor_analysis_logs',
-            engine,
-            if_exists='append',
-            index=False
-        )
+        # Single parameterized INSERT (get_engine creates the table if needed)
+        with get_engine().begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO social_media_competitor_analysis_logs (company, industry, competitor, report) "
+                    "VALUES (:company, :industry, :competitor, :report)"
+                ),
+                {"company": company, "industry": industry, "competitor": competitor, "report": report}
+            )
         print(f"✅ Competitor analysis report inserted for {company} vs {competitor}")
     except Exception as e:
         print(f"❌ Failed to insert competitor analysis report: {str(e)}")
 
+def _run_in_background(coro) -> asyncio.Task:
+    """Start a fire-and-forget task, keeping a reference until it finishes."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def insert_competitor_analysis_report_async(company: str, industry: str, competitor: str, report: str):
+    """Insert a competitor analysis report without blocking the event loop."""
+    await asyncio.to_thread(insert_competitor_analysis_report, company, industry, competitor, report)
+
+async def embed_competitor(competitor: str) -> Optional[List[float]]:
+    """Embed a competitor name for semantic cache lookups; returns None if embedding fails."""
+    # Only the raw name is embedded (company and industry must match exactly in the cache),
+    # so shared wording cannot drown out the difference between competitors
+    try:
+        response = await aclient.with_options(timeout=EMBEDDING_TIMEOUT_SECONDS).embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=competitor.strip()
+        )
+        return response.data[0].embedding
+    except Exception as e:
+        print(f"❌ Failed to embed analysis request: {str(e)}")
+        return None
+
+# Invariant instructions for every analysis, sent as a provider-cached prompt prefix
+ANALYSIS_SYSTEM_PROMPT = """You are an expert social media competitive intelligence analyst with deep knowledge of platform strategies, content marketing, and digital engagement across industries. Provide comprehensive, data-driven analysis with specific actionable recommendations.
+
+You will be asked to analyze a competitor for a company in a given industry. Provide a detailed analysis covering ALL of the following areas:
+
+## 1. PLATFORM IDENTIFICATION & PRESENCE
+- Identify the most relevant social media platforms for this industry
+- Analyze the competitor's presence on each platform (followers, posting frequency, verification status)
+- Rank platform importance and effectiveness for this competitor
+
+## 2. SOCIAL MEDIA PRESENCE ANALYSIS
+- Account sizes and growth trends across platforms
+- Posting frequency and timing patterns
+- Visual identity and brand consistency
+- Content formats and types used
+
+## 3. CONTENT STRATEGY ANALYSIS
+- Main content pillars and themes
+- Content calendar patterns and seasonal strategies
+- Brand voice, tone, and storytelling approach
+- Balance of promotional vs. value-based content
+- Top-performing content types and examples
+
+## 4. ENGAGEMENT METRICS & COMMUNITY
+- Average engagement rates by platform and content type
+- Audience response patterns and sentiment
+- Community management approach
+- Customer service on social platforms
+- User-generated content and advocacy
+
+## 5. COMPETITIVE POSITIONING
+- The competitor's social media strengths and weaknesses
+- How the company can differentiate on social platforms
+- Content gaps and underserved audience segments
+- Platform-specific opportunities for the company
+
+## 6. STRATEGIC RECOMMENDATIONS
+Provide actionable recommendations organized by timeline:
+- Quick wins (implementable within days)
+- Short-term tactics (1-3 months)
+- Medium-term initiatives (3-6 months)
+- Long-term strategic positioning (6+ months)
+
+## 7. MONITORING FRAMEWORK
+- Key metrics to track for ongoing competitive intelligence
+- Social listening priorities and keywords
+- Frequency and methods for monitoring competitor activities
+
+Format your response as a comprehensive report with clear headings, bullet points, and specific actionable insights. Include numerical data and metrics wherever possible. Base your analysis on the most current information available."""
+
+def _wait_for_retry_after(retry_state) -> float:
+    """Back off exponentially, but never less than the server's Retry-After header (capped)."""
+    backoff = _EXPONENTIAL_BACKOFF(retry_state)
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return max(min(float(retry_after), MAX_RETRY_AFTER_SECONDS), backoff) if retry_after else backoff
+    except ValueError:
+        return backoff
+
+def _is_retryable_llm_error(exc: BaseException) -> bool:
+    """Retry transient HTTP failures and transient errors reported mid-stream."""
+    if isinstance(exc, RETRYABLE_LLM_ERRORS):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return False  # Non-transient HTTP status such as 400 or 401
+    if isinstance(exc, openai.APIError):
+        # Errors after HTTP 200 arrive as an SSE error payload. OpenRouter uses string codes
+        # such as "server_error" (or none at all) for provider failures mid-stream.
+        if exc.code is None:
+            return True
+        try:
+            code = int(exc.code)
+        except (TypeError, ValueError):
+            return exc.code not in NON_TRANSIENT_STREAM_ERROR_CODES
+        return code == 429 or 500 <= code < 600
+    return False
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=_wait_for_retry_after,
+    retry=retry_if_exception(_is_retryable_llm_error),
+    reraise=True
+)
+async def generate_analysis_report(messages: List[dict]) -> str:
+    """Stream a report from OpenRouter, retrying transient failures with backoff."""
+    stream = await aclient.chat.completions.create(
+        model=MODEL,
+        messages=messages,
+        max_tokens=6000,  # Increased token limit for comprehensive analysis
+        stream=True
+    )
+
+    # Accumulate tokens as they arrive
+    report_parts = []
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            report_parts.append(chunk.choices[0].delta.content)
+    return "".join(report_parts)
+
 # --- Single Comprehensive Analysis Node ---
-def comprehensive_analysis_node(state: AgentState) -> dict:
+async def comprehensive_analysis_node(state: AgentState) -> dict:
     """Perform complete competitor analysis in a single comprehensive call."""
     
-    prompt = f"""
-    Conduct a comprehensive social media competitor analysis of {state['competitor']} for {state['company']} in the {state['industry']} industry.
-
-    Provide a detailed analysis covering ALL of the following areas:
-
-    ## 1. PLATFORM IDENTIFICATION & PRESENCE
-    - Identify the most relevant social media platforms for this industry
-    - Analyze {state['competitor']}'s presence on each platform (followers, posting frequency, verification status)
-    - Rank platform importance and effectiveness for this competitor
-
-    ## 2. SOCIAL MEDIA PRESENCE ANALYSIS
-    - Account sizes and growth trends across platforms
-    - Posting frequency and timing patterns
-    - Visual identity and brand consistency
-    - Content formats and types used
-
-    ## 3. CONTENT STRATEGY ANALYSIS
-    - Main content pillars and themes
-    - Content calendar patterns and seasonal strategies
-    - Brand voice, tone, and storytelling approach
-    - Balance of promotional vs. value-based content
-    - Top-performing content types and examples
-
-    ## 4. ENGAGEMENT METRICS & COMMUNITY
-    - Average engagement rates by platform and content type
-    - Audience response patterns and sentiment
-    - Community management approach
-    - Customer service on social platforms
-    - User-generated content and advocacy
-
-    ## 5. COMPETITIVE POSITIONING
-    - {state['competitor']}'s social media strengths and weaknesses
-    - How {state['company']} can differentiate on social platforms
-    - Content gaps and underserved audience segments
-    - Platform-specific opportunities for {state['company']}
-
-    ## 6. STRATEGIC RECOMMENDATIONS
-    Provide actionable recommendations organized by timeline:
-    - Quick wins (implementable within days)
-    - Short-term tactics (1-3 months)
-    - Medium-term initiatives (3-6 months)
-    - Long-term strategic positioning (6+ months)
-
-    ## 7. MONITORING FRAMEWORK
-    - Key metrics to track for ongoing competitive intelligence
-    - Social listening priorities and keywords
-    - Frequency and methods for monitoring competitor activities
-
-    Format your response as a comprehensive report with clear headings, bullet points, and specific actionable insights. Include numerical data and metrics wherever possible. Base your analysis on the most current information available.
-    """
+    # Only this short request varies per call; the cached system block stays identical
+    prompt = f"Conduct a comprehensive social media competitor analysis of {state['competitor']} (the competitor) for {state['company']} (the company) in the {state['industry']} industry."
     
     messages = [
         {
-            "role": "system", 
-            "content": "You are an expert social media competitive intelligence analyst with deep knowledge of platform strategies, content marketing, and digital engagement across industries. Provide comprehensive, data-driven analysis with specific actionable recommendations."
+            "role": "system",
+            "content": [
+                {
+                    "type": "text",
+                    "text": ANALYSIS_SYSTEM_PROMPT,
+                    "cache_control": {"type": "ephemeral"}
+                }
+            ]
         },
         {"role": "user", "content": prompt}
     ]
     
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=messages,
-        max_tokens=6000  # Increased token limit for comprehensive analysis
-    )
-    
-    report_content = response.choices[0].message.content
+    # Check the exact-match cache first, then the semantic cache (only worth waiting on the
+    # embedding when this company and industry already have cached competitors to compare)
+    cache_key = (state['company'], state['industry'], state['competitor'])
+    report_content = analysis_cache.get(cache_key)
+    embedding = None
+    if report_content is None and analysis_cache.has_semantic_candidates(cache_key):
+        embedding = await embed_competitor(state['competitor'])
+        report_content = analysis_cache.get(cache_key, embedding)
+    cache_hit = report_content is not None
+
+    if not cache_hit:
+        if embedding is None:
+            # Embed alongside the generation so the vector is ready for the cache
+            report_content, embedding = await asyncio.gather(
+                generate_analysis_report(messages),
+                embed_competitor(state['competitor'])
+            )
+        else:
+            report_content = await generate_analysis_report(messages)
+        analysis_cache.put(cache_key, embedding, report_content)
+        if analysis_cache.snapshot_due():
+            _run_in_background(analysis_cache.save_snapshot_async())
     
     # Extract key insights from the comprehensive analysis
     key_insights = []
     try:
-        # Look for key insight indicators in the response
-        lines = report_content.lower().split('\n')
-        insight_keywords = ['strength', 'weakness', 'opportunity', 'threat', 'advantage', 'gap', 'recommendation']
-        
-        for line in lines:
-            for keyword in insight_keywords:
-                if keyword in line and len(line.strip()) > 20 and len(line.strip()) < 150:
-                    # Clean up the line and add as insight
-                    clean_line = line.strip('- •*').strip()
-                    if clean_line and clean_line not in key_insights:
-                        key_insights.append(clean_line.capitalize())
-                        if len(key_insights) >= 5:  # Limit to top 5 insights
-                            break
-            if len(key_insights) >= 5:
-                break
+        # Look for key insight indicators in the response with a single regex scan
+        for match in _INSIGHT_LINE_RE.finditer(report_content):
+            line = match.group(0).strip()
+            if 20 < len(line) < 150:
+                # Clean up the line and add as insight
+                clean_line = line.strip('- •*').strip().capitalize()
+                if clean_line and clean_line not in key_insights:
+                    key_insights.append(clean_line)
+                    if len(key_insights) >= 5:  # Limit to top 5 insights
+                        break
                 
         # Fallback insights if extraction doesn't work well
         if len(key_insights) < 3:
@@ -185,13 +375,17 @@ def comprehensive_analysis_node(state: AgentState) -> dict:
     # Create analysis summary
     analysis_summary = f"Completed comprehensive social media competitive analysis of {state['competitor']} in the {state['industry']} industry for {state['company']}. Analysis covered platform presence, content strategy, engagement metrics, competitive positioning, and strategic recommendations with actionable timelines."
     
-    # Insert the report into the database
-    insert_competitor_analysis_report(
-        state['company'],
-        state['industry'],
-        state['competitor'],
-        report_content
-    )
+    # Insert the report into the database in the background (cached reports are already stored)
+    if not cache_hit:
+        task = _run_in_background(insert_competitor_analysis_report_async(
+            state['company'],
+            state['industry'],
+            state['competitor'],
+            report_content
+        ))
+        batch_tasks = _batch_insert_tasks.get()
+        if batch_tasks is not None:
+            batch_tasks.add(task)
 
     return {
         "report": report_content,
@@ -216,6 +410,33 @@ builder.add_edge("comprehensive_analysis", END)
 # Compile the graph
 graph = builder.compile() 
 
+async def batch_analyze(inputs: List[AgentInput]) -> List[AgentOutput]:
+    """Run several competitor analyses concurrently, bounded by MAX_CONCURRENT_ANALYSES."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+    # Collects the report inserts started by this batch (the context is copied into each task)
+    insert_tasks = set()
+    token = _batch_insert_tasks.set(insert_tasks)
+
+    async def run_one(agent_input: AgentInput) -> AgentOutput:
+        async with semaphore:
+            return await graph.ainvoke(agent_input)
+
+    # Analyze each normalized (company, industry, competitor) triple only once
+    keys = [analysis_cache.make_key((i['company'], i['industry'], i['competitor'])) for i in inputs]
+    unique_inputs = dict(zip(keys, inputs))  # Later duplicates map to an equivalent input
+
+    try:
+        unique_results = await asyncio.gather(*[run_one(i) for i in unique_inputs.values()])
+    finally:
+        _batch_insert_tasks.reset(token)
+
+    # Let this batch's report inserts finish before the caller's event loop shuts down
+    if insert_tasks:
+        await asyncio.gather(*insert_tasks)
+
+    results_by_key = dict(zip(unique_inputs.keys(), unique_results))
+    return [dict(results_by_key[key]) for key in keys]
+
 # # --- Local runner for testing ---
 # def main():
 #     """Run a sample competitor analysis locally for testing purposes."""
@@ -225,8 +446,8 @@ graph = builder.compile()
 #         "competitor": "Double Dragon Corporation"
 #     }
 #     print("Running competitor analysis for sample input:\n", sample_input)
-#     # Run the graph synchronously
-#     result = graph.invoke(sample_input)
+#     # Run the graph on the event loop (the analysis node is async)
+#     result = asyncio.run(graph.ainvoke(sample_input))
 #     print("\n--- Analysis Output ---\n")
 #     for k, v in result.items():
 #         print(f"{k}:\n{v}\n{'-'*40}")
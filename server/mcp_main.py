@@ -27,7 +27,7 @@ def greet(name: str) -> str:
     return f"Hello {name}!"
 
 @mcp.tool(description="Performs a comprehensive social media competitor analysis.")
-def competitor_analysis(company: str, industry: str, competitor: str) -> dict:
+async def competitor_analysis(company: str, industry: str, competitor: str) -> dict:
     """
     Performs a comprehensive social media competitor analysis using the competitor_analysis_agent.
 
@@ -39,16 +39,32 @@ def competitor_analysis(company: str, industry: str, competitor: str) -> dict:
     Returns:
     - dict: Contains 'report', 'analysis_summary', and 'key_insights'.
     """
-    result = graph.invoke({
+    result = await graph.ainvoke({
         "company": company,
         "industry": industry,
         "competitor": competitor
     })
     return result
 
+def create_http_app():
+    """Build the MCP HTTP app; used as a uvicorn factory so each worker builds its own."""
+    # Stateless: sessions live in per-process memory, so with several workers a follow-up
+    # request could land on a worker that never saw the client's initialize call
+    return mcp.http_app(middleware=middleware, stateless_http=True)
+
 if __name__ == "__main__":
+    import os
     import uvicorn
 
-    http_app = mcp.http_app(middleware=middleware)
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    os.environ["WEB_CONCURRENCY"] = str(workers)  # Workers size their DB pools from this
 
-    uvicorn.run(http_app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "mcp_main:create_http_app",
+        factory=True,
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="auto",  # uvloop when installed (not available on Windows)
+        http="httptools",
+    )
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Make the repository root importable (server/ is a namespace package)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The agent builds its OpenRouter client at import time, which requires an API key
+os.environ.setdefault("OPENROUTER_API_KEY", "test-key")
@@ -0,0 +1,114 @@
+import asyncio
+import importlib
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from server import analysis_cache
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """A fresh, empty cache module with a controllable clock and no snapshot path."""
+    monkeypatch.delenv("ANALYSIS_CACHE_PATH", raising=False)
+    module = importlib.reload(analysis_cache)
+    monkeypatch.setattr(module, "time", FakeClock())
+    return module
+
+
+def reload_with_snapshot(monkeypatch, path):
+    """Simulate a separate worker process starting up with ANALYSIS_CACHE_PATH set."""
+    monkeypatch.setenv("ANALYSIS_CACHE_PATH", str(path))
+    return importlib.reload(analysis_cache)
+
+
+def unit(*values):
+    return (np.asarray(values, dtype=np.float32) / np.linalg.norm(values)).tolist()
+
+
+def test_eviction_frees_and_reuses_slots(cache, monkeypatch):
+    monkeypatch.setattr(cache, "MAX_ENTRIES", 3)
+    monkeypatch.setattr(cache, "_INITIAL_VECTOR_ROWS", 2)
+
+    for i in range(3):
+        cache.put(("A", "I", f"C{i}"), unit(1, i), f"r{i}")
+        cache.time.now += 1
+    assert cache._vectors.shape[0] == 4  # Grew from 2 rows by doubling
+    first_slot = cache._entries[cache.make_key(("A", "I", "C0"))]["slot"]
+
+    cache.put(("A", "I", "C3"), unit(1, 3), "r3")
+
+    assert cache.get(("A", "I", "C0")) is None
+    assert cache.get(("A", "I", "C3")) == "r3"
+    assert len(cache._entries) == 3
+    assert cache._vectors.shape[0] == 4  # No growth: freed rows are reused
+    assert cache._entries[cache.make_key(("A", "I", "C3"))]["slot"] == first_slot
+    assert cache._free_slots == [3]
+    assert len(cache._scope_slots[("a", "i")]) == 3
+
+
+def test_semantic_hits_stay_within_company_and_industry(cache):
+    cache.put(("Adidas", "Apparel", "Nike"), unit(1, 0, 0), "nike report")
+    near = unit(1, 0.05, 0)
+
+    assert cache.get((" adidas", "APPAREL ", "Nike Inc."), near) == "nike report"
+    assert cache.get(("Puma", "Apparel", "Nike Inc."), near) is None
+    assert cache.get(("Adidas", "Footwear", "Nike Inc."), near) is None
+    assert cache.get(("Adidas", "Apparel", "Reebok"), unit(0, 1, 0)) is None
+    assert cache.has_semantic_candidates(("adidas", "apparel", "anything"))
+    assert not cache.has_semantic_candidates(("Puma", "Apparel", "Nike"))
+
+
+def test_dimension_mismatch_falls_back_to_exact_match(cache):
+    cache.put(("A", "I", "C1"), unit(1, 0, 0), "r1")
+
+    assert cache.get(("A", "I", "C2"), unit(1, 0, 0, 0)) is None
+
+    cache.put(("A", "I", "C2"), unit(1, 0, 0, 0), "r2")
+    assert cache._entries[cache.make_key(("A", "I", "C2"))]["slot"] is None
+    assert cache.get(("A", "I", "C2")) == "r2"
+
+
+def test_entries_expire_after_ttl(cache, monkeypatch):
+    monkeypatch.setattr(cache, "TTL_SECONDS", 10)
+    cache.put(("A", "I", "C"), unit(1, 0), "r")
+
+    cache.time.now += 10
+    assert cache.get(("A", "I", "C")) == "r"
+
+    cache.time.now += 0.001
+    assert cache.get(("A", "I", "C")) is None
+    assert not cache.has_semantic_candidates(("A", "I", "C"))
+    assert len(cache._free_slots) == cache._vectors.shape[0]
+
+
+def test_snapshot_round_trip_merges_workers(monkeypatch, tmp_path):
+    path = tmp_path / "cache.npz"
+
+    worker_a = reload_with_snapshot(monkeypatch, path)
+    worker_a.put(("A", "I", "Nike"), unit(1, 0, 0), "nike report")
+    worker_a.put(("A", "I", "Shared"), None, "old shared report")
+    asyncio.run(worker_a.save_snapshot_async())
+
+    # The second worker started before that snapshot existed, so it never saw those entries
+    monkeypatch.delenv("ANALYSIS_CACHE_PATH")
+    worker_b = importlib.reload(analysis_cache)
+    monkeypatch.setattr(worker_b, "SNAPSHOT_PATH", str(path))
+    worker_b.put(("B", "J", "Puma"), unit(0, 1, 0), "puma report")
+    worker_b.put(("A", "I", "Shared"), None, "new shared report")
+    asyncio.run(worker_b.save_snapshot_async())
+
+    restarted = reload_with_snapshot(monkeypatch, path)
+    assert restarted.get(("A", "I", "Nike Inc."), unit(1, 0.05, 0)) == "nike report"
+    assert restarted.get(("B", "J", "Puma")) == "puma report"
+    assert restarted.get(("A", "I", "Shared")) == "new shared report"
+    assert len(restarted._entries) == 3
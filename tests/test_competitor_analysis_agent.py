@@ -0,0 +1,103 @@
+import asyncio
+import importlib
+
+import pytest
+
+pytest.importorskip("langgraph")
+openai = pytest.importorskip("openai")
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("numpy")
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("tenacity")
+
+from server import analysis_cache
+from server import competitor_analysis_agent as agent
+
+
+@pytest.fixture
+def fake_backends(monkeypatch):
+    """Replace the LLM, embedding and DB calls with counters on a fresh, empty cache."""
+    monkeypatch.delenv("ANALYSIS_CACHE_PATH", raising=False)
+    importlib.reload(analysis_cache)
+    calls = {"llm": 0, "insert": 0}
+
+    async def fake_generate(messages):
+        calls["llm"] += 1
+        await asyncio.sleep(0.01)
+        return f"report {calls['llm']}"
+
+    async def fake_embed(competitor):
+        return None
+
+    def fake_insert(company, industry, competitor, report):
+        calls["insert"] += 1
+
+    monkeypatch.setattr(agent, "generate_analysis_report", fake_generate)
+    monkeypatch.setattr(agent, "embed_competitor", fake_embed)
+    monkeypatch.setattr(agent, "insert_competitor_analysis_report", fake_insert)
+    return calls
+
+
+def test_batch_analyze_runs_each_normalized_triple_once(fake_backends):
+    inputs = [{"company": "A", "industry": "I", "competitor": f"C{i}"} for i in range(5)]
+    inputs.append({"company": "a ", "industry": "i", "competitor": "c0"})
+
+    results = asyncio.run(agent.batch_analyze(inputs))
+
+    assert fake_backends == {"llm": 5, "insert": 5}
+    assert len(results) == 6
+    assert results[5]["report"] == results[0]["report"]
+    assert results[5] is not results[0]
+
+
+def test_report_insert_creates_the_table_on_a_fresh_database(monkeypatch, tmp_path):
+    monkeypatch.setattr(agent, "DATABASE_URL", f"sqlite:///{tmp_path / 'reports.db'}")
+    monkeypatch.setattr(agent, "_ENGINE", None)
+
+    agent.insert_competitor_analysis_report("A", "I", "C", "report")
+
+    with agent.get_engine().connect() as conn:
+        rows = conn.execute(agent.text(
+            "SELECT company, industry, competitor, report FROM social_media_competitor_analysis_logs"
+        )).all()
+    assert [tuple(row) for row in rows] == [("A", "I", "C", "report")]
+    agent.get_engine().dispose()
+
+
+def _stream_error(code):
+    """The plain APIError the SDK raises for an SSE error payload received after HTTP 200."""
+    body = {"message": "Provider disconnected"}
+    if code is not None:
+        body["code"] = code
+    return openai.APIError(body["message"], httpx.Request("POST", "https://openrouter.ai/api/v1"), body=body)
+
+
+@pytest.mark.parametrize("code", ["server_error", None, 502, "429"])
+def test_transient_mid_stream_errors_are_retried(code):
+    assert agent._is_retryable_llm_error(_stream_error(code))
+
+
+@pytest.mark.parametrize("code", ["context_length_exceeded", 400])
+def test_non_transient_mid_stream_errors_are_not_retried(code):
+    assert not agent._is_retryable_llm_error(_stream_error(code))
+
+
+def test_http_status_errors_follow_their_status():
+    request = httpx.Request("POST", "https://openrouter.ai/api/v1")
+    bad_request = openai.BadRequestError("bad", response=httpx.Response(400, request=request), body=None)
+    unavailable = openai.InternalServerError("down", response=httpx.Response(503, request=request), body=None)
+
+    assert not agent._is_retryable_llm_error(bad_request)
+    assert agent._is_retryable_llm_error(unavailable)
+
+
+@pytest.mark.parametrize("max_connections,workers", [(80, 0), (80, 1), (80, 7), (80, 40), (80, 64), (80, 80)])
+def test_db_pools_stay_within_the_connection_budget(max_connections, workers):
+    pool_size, max_overflow = agent.db_pool_limits(max_connections, workers)
+
+    assert pool_size >= 1 and max_overflow >= 0
+    assert (pool_size + max_overflow) * max(1, workers) <= max_connections
+
+
+def test_single_worker_db_pool_keeps_previous_size():
+    assert agent.db_pool_limits(80, 1) == (10, 20)